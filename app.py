@@ -1,11 +1,30 @@
 import os
-from flask import Flask, render_template, request, send_file
+import asyncio
+import contextlib
+import hashlib
+import random
+import re
+import signal
+import functools
+import json
+import multiprocessing
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from quart import Quart, Response, render_template, request, send_file, stream_template
 import pdfplumber
+import pypdfium2 as pdfium
 import docx
 import logging
 from werkzeug.utils import secure_filename
 import google.generativeai as genai
-from fpdf import FPDF  # pip install fpdf
+from google.api_core import exceptions as google_exceptions
+from aiolimiter import AsyncLimiter
+from html import escape
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer
 from dotenv import load_dotenv
 
 load_dotenv(".env.local")  
@@ -16,69 +35,603 @@ if not GOOGLE_API_KEY:
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-genai.configure(api_key=GOOGLE_API_KEY)
-model = genai.GenerativeModel("gemini-1.5-flash")  # Using flash for higher quota
+MODEL_NAME = "gemini-1.5-flash"  # Using flash for higher quota
 
-app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = 'uploads/'
+# Invariant instructions, set as the model's system instruction. They are
+# sent (and billed) with every request; nothing caches them server-side.
+MCQ_INSTRUCTIONS = """You are an AI assistant generating MCQs from the text the user provides.
+Format every question exactly as:
+## MCQ
+Question: [question]
+A) [option A]
+B) [option B]
+C) [option C]
+D) [option D]
+Correct Answer: [correct option]
+"""
+# Per-request prompt; the dynamic text stays last so every request shares a
+# byte-identical prefix
+PROMPT_TEMPLATE = """Generate MCQs from the text below.
+Number of MCQs: {n}
+Text:
+'{text}'
+"""
+PROMPT_HEAD_BYTES = PROMPT_TEMPLATE.split("{text}")[0].encode('utf-8')
+# Folded into response cache keys so prompt edits invalidate stale entries
+PROMPT_VERSION = hashlib.sha256(MCQ_INSTRUCTIONS.encode('utf-8') + PROMPT_HEAD_BYTES).hexdigest()[:12]
+logging.info(f"Prompt version {PROMPT_VERSION} ({len(PROMPT_HEAD_BYTES)}-byte shared prefix)")
+# Created per worker in init_gemini() once the server has started it
+model = None
+
+# Several concurrent prompts can share one request; each answer is returned
+# under its request's random id, which a document's own text cannot forge,
+# so it can be routed back to the caller
+BATCH_PREAMBLE = """You will receive {count} independent requests, each introduced by "=== REQUEST <id> ===".
+Answer every request separately. Begin each answer with a line "=== RESPONSE <id> ===" using the request's id, and write nothing outside those sections.
+"""
+BATCH_RESPONSE_MARKER = re.compile(r"^=== RESPONSE ([0-9a-f]{32}) ===[ \t]*$", re.MULTILINE)
+
+app = Quart(__name__)
+# Uploads are transient (deleted once their text is extracted), so keep
+# them on tmpfs when the host has one
+app.config['UPLOAD_FOLDER'] = os.environ.get(
+    "UPLOAD_FOLDER", '/dev/shm/mcq_uploads/' if os.path.isdir('/dev/shm') else 'uploads/'
+)
 app.config['RESULTS_FOLDER'] = 'results/'
+app.config['CACHE_FOLDER'] = os.path.join(app.config['RESULTS_FOLDER'], '.cache')
+app.config['TEXT_CACHE_FOLDER'] = os.path.join(app.config['RESULTS_FOLDER'], '.textcache')
+app.config['JOBS_FOLDER'] = os.path.join(app.config['RESULTS_FOLDER'], '.jobs')
 app.config['ALLOWED_EXTENSIONS'] = {'pdf', 'txt', 'docx'}
+# Behind nginx, set this to an internal location aliased to RESULTS_FOLDER
+# (e.g. "/protected-results/") so downloads are served via X-Accel-Redirect
+app.config['X_ACCEL_REDIRECT_PREFIX'] = os.environ.get("X_ACCEL_REDIRECT_PREFIX")
+
+@app.before_serving
+async def init_gemini():
+    # Configuring the client inside each worker, rather than at import time in
+    # a parent that later forks, gives every worker its own long-lived channel
+    # that is reused across all of its requests
+    global model
+    genai.configure(api_key=GOOGLE_API_KEY)
+    model = genai.GenerativeModel(MODEL_NAME, system_instruction=MCQ_INSTRUCTIONS)
 
 # Ensure folders exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['RESULTS_FOLDER'], exist_ok=True)
+os.makedirs(app.config['CACHE_FOLDER'], exist_ok=True)
+os.makedirs(app.config['TEXT_CACHE_FOLDER'], exist_ok=True)
+os.makedirs(app.config['JOBS_FOLDER'], exist_ok=True)
+
+# Writes the downloadable .txt/.pdf after the response has been sent. Job
+# status lives on disk so /status answers from any worker process.
+persist_executor = ThreadPoolExecutor(max_workers=4)
+# Results pages stop polling long before this, so older markers are swept
+JOB_MARKER_TTL_SECONDS = 3600
+
+# Hit/miss counters for the Gemini response cache
+cache_stats = {"hits": 0, "normalized_hits": 0, "coalesced": 0, "misses": 0}
+
+# Response cache key -> future for generations currently in progress in this
+# worker; identical uploads routed to different workers are not coalesced
+_inflight = {}
+
+# Number of server worker processes (set by the Procfile). Every worker holds
+# its own limiter, Gemini semaphore, PDF pool and in-flight map, so shared
+# budgets below are split between them. One async worker already serves many
+# uploads at once; more than two mostly just fragments the Gemini budget.
+WEB_WORKERS = max(1, int(os.environ.get("WEB_CONCURRENCY", 1)))
+
+# Caps in-flight Gemini calls at the per-model concurrency limit and paces
+# them to the quota tier, retrying 429/5xx with jittered backoff. Both limits
+# are totals for the whole deployment, divided evenly across workers.
+GEMINI_TOTAL_CONCURRENCY = int(os.environ.get("GEMINI_MAX_CONCURRENCY", 4))
+GEMINI_TOTAL_RPM = int(os.environ.get("GEMINI_RPM", 15))
+if WEB_WORKERS > min(GEMINI_TOTAL_CONCURRENCY, GEMINI_TOTAL_RPM):
+    raise ValueError(
+        f"WEB_CONCURRENCY={WEB_WORKERS} exceeds the Gemini budget "
+        f"(GEMINI_MAX_CONCURRENCY={GEMINI_TOTAL_CONCURRENCY}, GEMINI_RPM={GEMINI_TOTAL_RPM}); run fewer workers"
+    )
+GEMINI_MAX_CONCURRENCY = GEMINI_TOTAL_CONCURRENCY // WEB_WORKERS
+GEMINI_RPM = GEMINI_TOTAL_RPM // WEB_WORKERS
+GEMINI_MAX_ATTEMPTS = 3
+GEMINI_BACKOFF_BASE = 1.0
+GEMINI_BACKOFF_JITTER = 1.0
+GEMINI_RETRYABLE_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.InternalServerError,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+)
+gemini_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+gemini_limiter = AsyncLimiter(GEMINI_RPM, 60)
+
+# PDF pages are parsed across processes once a document is big enough to
+# amortize the hand-off
+PDF_MIN_PAGES_PER_WORKER = 8
+# Graphics-heavy pages can take pdfminer seconds each; give up on a page
+# rather than stall the upload
+PDF_PAGE_TIMEOUT_SECONDS = 0.5
+# Spawned rather than forked: forking a server worker that already has
+# asyncio and gRPC threads running can deadlock the children
+pdf_executor = ProcessPoolExecutor(
+    max_workers=max(1, (os.cpu_count() or 1) // WEB_WORKERS),
+    mp_context=multiprocessing.get_context("spawn"),
+)
+
+# Long inputs are split into chunks that are prompted in parallel
+CHUNK_SIZE = 4000
+MAX_CHUNKS = 8
+
+# Extraction stops once it has as much text as the prompts can use
+MAX_EXTRACT_CHARS = CHUNK_SIZE * MAX_CHUNKS
+# Folded into text cache keys; bump whenever extraction output can change
+EXTRACTOR_VERSION = 2
+
+_ALLOWED_SUFFIXES = tuple('.' + ext for ext in app.config['ALLOWED_EXTENSIONS'])
 
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
+    return filename.lower().endswith(_ALLOWED_SUFFIXES)
+
+class _PageTimeout(Exception):
+    pass
+
+def _raise_page_timeout(signum, frame):
+    raise _PageTimeout()
+
+def _extract_page_text(page):
+    # pdfminer still interprets every drawing operator on the page, so the
+    # timeout below is what bounds graphics-heavy pages. SIGALRM can only be
+    # armed from the main thread, which is where pool workers run; inline
+    # extraction goes without the guard. Returns None for a skipped page.
+    if threading.current_thread() is not threading.main_thread() or not hasattr(signal, 'setitimer'):
+        return page.extract_text() or ''
+
+    previous_handler = signal.signal(signal.SIGALRM, _raise_page_timeout)
+    try:
+        signal.setitimer(signal.ITIMER_REAL, PDF_PAGE_TIMEOUT_SECONDS)
+        return page.extract_text() or ''
+    except _PageTimeout:
+        logging.warning(f"Skipping PDF page {page.page_number}: extraction exceeded {PDF_PAGE_TIMEOUT_SECONDS}s")
+        return None
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+def _extract_pdf_pages(file_path, page_numbers):
+    # pdfplumber page numbers are 1-based; laparams=None skips layout analysis.
+    # Returns the text and whether any page had to be skipped.
+    with pdfplumber.open(file_path, pages=page_numbers, laparams=None) as pdf:
+        texts = []
+        skipped = False
+        for page in pdf.pages:
+            text = _extract_page_text(page)
+            if text is None:
+                skipped = True
+            texts.append(text or '')
+            # Release the page's parsed objects before moving on
+            page.close()
+        return '\n'.join(texts), skipped
+
+def _iter_pdf_pages_pdfium(file_path):
+    # PDFium extracts plain text natively with no layout analysis
+    pdf = pdfium.PdfDocument(file_path)
+    try:
+        for page in pdf:
+            textpage = page.get_textpage()
+            yield textpage.get_text_bounded().replace('\r\n', '\n')
+            textpage.close()
+            page.close()
+    finally:
+        pdf.close()
+
+def _iter_pdf_pages_pdfplumber(file_path, progress):
+    # Clears ``progress["complete"]`` if a page timed out
+    with pdfplumber.open(file_path) as pdf:
+        num_pages = len(pdf.pages)
+    if num_pages < 2 * PDF_MIN_PAGES_PER_WORKER:
+        text, skipped = _extract_pdf_pages(file_path, None)
+        if skipped:
+            progress["complete"] = False
+        yield text
+        return
+
+    # Ranges are handed out in page order; whatever has not started when the
+    # consumer stops reading is cancelled
+    futures = [
+        pdf_executor.submit(_extract_pdf_pages, file_path, list(range(start + 1, min(start + PDF_MIN_PAGES_PER_WORKER, num_pages) + 1)))
+        for start in range(0, num_pages, PDF_MIN_PAGES_PER_WORKER)
+    ]
+    try:
+        for future in futures:
+            text, skipped = future.result()
+            if skipped:
+                progress["complete"] = False
+            yield text
+    finally:
+        for future in futures:
+            future.cancel()
+
+def _collect_text(pieces):
+    collected = []
+    size = 0
+    try:
+        for piece in pieces:
+            collected.append(piece)
+            size += len(piece) + 1
+            if size >= MAX_EXTRACT_CHARS:
+                break
+    finally:
+        pieces.close()
+    return '\n'.join(collected)[:MAX_EXTRACT_CHARS]
+
+def _extract_pdf_text_pdfium(file_path):
+    return _collect_text(_iter_pdf_pages_pdfium(file_path))
+
+def extract_text_from_pdf(file_path, progress):
+    # PDFium must never be entered from two threads at once, even for
+    # different documents, so it only runs in the single-threaded pool workers
+    try:
+        return pdf_executor.submit(_extract_pdf_text_pdfium, file_path).result()
+    except Exception as e:
+        logging.warning(f"PDFium extraction failed, falling back to pdfplumber: {e}")
+    return _collect_text(_iter_pdf_pages_pdfplumber(file_path, progress))
+
+def extract_text_cached(file_path):
+    # Keyed by the uploaded bytes (plus extension, which picks the parser)
+    ext = os.path.splitext(file_path)[1].lower().lstrip('.')
+    if not ext:
+        logging.error(f"Uploaded file has no extension: {file_path}")
+        return None
+    try:
+        with open(file_path, 'rb') as f:
+            digest = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+    except OSError as e:
+        logging.error(f"Error hashing uploaded file: {e}")
+        return extract_text_from_file(file_path, {"complete": True})
 
-def extract_text_from_file(file_path):
+    cache_path = os.path.join(app.config['TEXT_CACHE_FOLDER'], f"{digest}.v{EXTRACTOR_VERSION}.{ext}.txt")
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            logging.info(f"Text cache hit for {digest}")
+            return f.read()
+    except FileNotFoundError:
+        pass
+
+    progress = {"complete": True}
+    text = extract_text_from_file(file_path, progress)
+    # Text with skipped pages is still used for this upload, but a page that
+    # was only slow because the host was busy must not lose its text for good
+    if text and progress["complete"]:
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            logging.error(f"Error writing text cache: {e}")
+    return text
+
+def extract_text_from_file(file_path, progress):
     try:
         ext = file_path.rsplit('.', 1)[1].lower()
         if ext == 'pdf':
-            with pdfplumber.open(file_path) as pdf:
-                return '\n'.join([page.extract_text() or '' for page in pdf.pages])
+            return extract_text_from_pdf(file_path, progress)
         elif ext == 'docx':
-            return '\n'.join([para.text for para in docx.Document(file_path).paragraphs])
+            return _collect_text(para.text for para in docx.Document(file_path).paragraphs)
         elif ext == 'txt':
             with open(file_path, 'r', encoding='utf-8') as file:
-                return file.read()
+                return file.read(MAX_EXTRACT_CHARS)
     except Exception as e:
         logging.error(f"Error extracting text from file: {e}")
     return None
 
-def Question_mcqs_generator(input_text, num_questions):
-    logging.info("Generating MCQs from input text")
-    prompt = f"""
-    Generate {num_questions} MCQs from the following text:
-    '{input_text[:1000]}'
-    Format:
-    ## MCQ
-    Question: [question]
-    A) [option A]
-    B) [option B]
-    C) [option C]
-    D) [option D]
-    Correct Answer: [correct option]
-    """
+def response_cache_key(input_text, num_questions):
+    return hashlib.sha256(f"{MODEL_NAME}|{PROMPT_VERSION}|{num_questions}|{input_text}".encode('utf-8')).hexdigest()
+
+def _response_cache_path(key):
+    return os.path.join(app.config['CACHE_FOLDER'], f"{key}.txt")
+
+@functools.lru_cache(maxsize=512)
+def _read_cached_response(key):
+    # A miss raises FileNotFoundError, which lru_cache does not memoize
+    with open(_response_cache_path(key), 'r', encoding='utf-8') as f:
+        return f.read()
+
+def _write_cached_response(key, mcqs):
+    cache_path = _response_cache_path(key)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
     try:
-        response = model.generate_content(prompt)
-        logging.info(f"Full Gemini API Response: {response}")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(mcqs)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logging.error(f"Error writing response cache: {e}")
 
-        if hasattr(response, "text") and response.text:
-            return response.text.strip()
-        elif hasattr(response, "candidates"):
-            text_parts = []
-            for part in response.candidates[0].content.parts:
-                if hasattr(part, "text") and part.text:
-                    text_parts.append(part.text)
-            if text_parts:
-                return "\n".join(text_parts).strip()
+def normalized_cache_key(input_text, num_questions):
+    # Every response is also cached under its case/whitespace-normalized text,
+    # so re-formatted uploads of the same document (re-exported PDFs, re-wrapped
+    # lines) still hit. This is an exact match on the normalized text, not a
+    # similarity search.
+    return response_cache_key(' '.join(input_text.lower().split()), num_questions)
+
+async def Question_mcqs_generator(input_text, num_questions):
+    """Yield the MCQ text as it becomes available, serving cache hits whole."""
+    key = response_cache_key(input_text, num_questions)
+    normalized_key = normalized_cache_key(input_text, num_questions)
+    # Re-checked after every wait: when an in-flight leader finishes without a
+    # result, exactly one waiter takes over as leader and the rest wait on it
+    while True:
+        try:
+            mcqs = await asyncio.to_thread(_read_cached_response, key)
+            cache_stats["hits"] += 1
+            logging.info(f"Response cache hit for {key[:12]} ({cache_stats})")
+            yield mcqs
+            return
+        except FileNotFoundError:
+            pass
+        try:
+            mcqs = await asyncio.to_thread(_read_cached_response, normalized_key)
+            cache_stats["normalized_hits"] += 1
+            logging.info(f"Normalized text cache hit for {key[:12]} ({cache_stats})")
+            yield mcqs
+            return
+        except FileNotFoundError:
+            pass
 
+        # An identical request already in flight: wait for its result instead
+        # of paying for a second generation
+        leader = _inflight.get(key)
+        if leader is None:
+            break
+        mcqs = await asyncio.shield(leader)
+        if mcqs:
+            cache_stats["coalesced"] += 1
+            logging.info(f"Coalesced with in-flight request for {key[:12]} ({cache_stats})")
+            yield mcqs
+            return
+
+    cache_stats["misses"] += 1
+    # Registered before the first await so concurrent duplicates wait on it
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+    try:
+        logging.info("Generating MCQs from input text")
+        progress = {"outputs": [], "complete": False}
+        async for piece in _stream_with_gemini(input_text, num_questions, progress):
+            yield piece
+        mcqs = merge_mcqs(progress["outputs"])
+        # A partial answer is still shown to this user, but it must not be
+        # served to anyone else under the full request's key
+        if mcqs and progress["complete"]:
+            await asyncio.to_thread(_write_cached_response, key, mcqs)
+            if normalized_key != key:
+                await asyncio.to_thread(_write_cached_response, normalized_key, mcqs)
+            future.set_result(mcqs)
+    finally:
+        # Waiters must be released even if this stream is abandoned mid-way
+        if not future.done():
+            future.set_result(None)
+        if _inflight.get(key) is future:
+            del _inflight[key]
+
+def split_into_chunks(text, num_questions):
+    chunks = [text[i:i + CHUNK_SIZE] for i in range(0, len(text), CHUNK_SIZE)]
+    # Never ask a chunk for zero questions, and bound the fan-out per request
+    return chunks[:max(1, min(num_questions, MAX_CHUNKS))]
+
+def questions_per_chunk(num_questions, num_chunks):
+    base, extra = divmod(num_questions, num_chunks)
+    return [base + 1 if i < extra else base for i in range(num_chunks)]
+
+def build_prompt(chunk, num_questions):
+    return PROMPT_TEMPLATE.format(n=num_questions, text=chunk)
+
+def merge_mcqs(outputs):
+    blocks = []
+    for output in outputs:
+        blocks.extend(block.strip() for block in output.split("## MCQ") if block.strip())
+    return "\n\n".join(f"## MCQ\n{block}" for block in blocks)
+
+async def _stream_with_gemini(input_text, num_questions, progress):
+    # The first chunk is streamed token by token while the remaining chunks
+    # are generated concurrently and emitted in order once it finishes.
+    # Each chunk's full text is appended to ``progress["outputs"]``, and
+    # ``progress["complete"]`` is set only if every chunk succeeded.
+    outputs = progress["outputs"]
+    chunks = split_into_chunks(input_text, num_questions)
+    counts = questions_per_chunk(num_questions, len(chunks))
+    prompts = [build_prompt(chunk, count) for chunk, count in zip(chunks, counts)]
+    # The first chunk is read by its own task so that the concurrency slot is
+    # held for exactly as long as Gemini is streaming, independent of how fast
+    # the browser consumes the page. It is created first so it takes a slot
+    # ahead of the remaining chunks.
+    pieces = asyncio.Queue()
+    reader = asyncio.create_task(_stream_chunk(prompts[0], pieces))
+    request_id = uuid.uuid4().hex
+    tasks = [
+        asyncio.create_task(gemini_batcher.submit(prompt, count, request_id))
+        for prompt, count in zip(prompts[1:], counts[1:])
+    ]
+    streamed = []
+    failed = False
+    try:
+        try:
+            while (text := await pieces.get()) is not None:
+                streamed.append(text)
+                yield text
+            await reader
+        except Exception:
+            logging.exception("Error streaming MCQs for the first chunk")
+            failed = True
+        if streamed:
+            outputs.append(''.join(streamed))
+        else:
+            failed = True
+
+        for task in tasks:
+            try:
+                text = await task
+            except Exception:
+                logging.exception("Error generating MCQs for a chunk")
+                failed = True
+                continue
+            if not text:
+                failed = True
+                continue
+            yield f"\n\n{text}" if outputs else text
+            outputs.append(text)
+        progress["complete"] = not failed
+    finally:
+        reader.cancel()
+        for task in tasks:
+            task.cancel()
+
+async def _stream_chunk(prompt, pieces):
+    try:
+        async with _gemini_call(prompt, stream=True) as response:
+            async for chunk in response:
+                text = _response_text(chunk)
+                if text:
+                    pieces.put_nowait(text)
+    finally:
+        pieces.put_nowait(None)
+
+@contextlib.asynccontextmanager
+async def _gemini_call(contents, stream=False):
+    # Yields the response while holding a concurrency slot, so a stream is read
+    # under it. The slot is given back while a retry backs off, so a 429 burst
+    # does not leave every slot asleep.
+    for attempt in range(GEMINI_MAX_ATTEMPTS):
+        async with gemini_semaphore:
+            try:
+                async with gemini_limiter:
+                    response = await model.generate_content_async(contents, stream=stream)
+            except GEMINI_RETRYABLE_ERRORS as e:
+                if attempt == GEMINI_MAX_ATTEMPTS - 1:
+                    raise
+                delay = GEMINI_BACKOFF_BASE * 2 ** attempt + random.uniform(0, GEMINI_BACKOFF_JITTER)
+                logging.warning(f"Gemini call failed ({e.__class__.__name__}); retrying in {delay:.1f}s")
+            else:
+                yield response
+                return
+        await asyncio.sleep(delay)
+
+async def _generate_text(contents):
+    async with _gemini_call(contents) as response:
+        pass
+    logging.info(f"Full Gemini API Response: {response}")
+    text = _response_text(response)
+    if not text:
         logging.error("Gemini returned no usable text.")
-        return None
-    except Exception as e:
-        logging.exception("Error generating MCQs")
-        return None
+    return text
+
+class AsyncBatcher:
+    """Coalesce prompts from different requests into one Gemini call.
+
+    Prompts are sent as separate parts of a single request and the answer is
+    split back on markers carrying a random id per prompt. Each section must
+    carry its own prompt's id and hold the number of MCQs that prompt asked
+    for; otherwise the whole batch is retried one prompt at a time, so one
+    user's document can never answer another's.
+
+    A batch holds at most one prompt per ``request_id``: a request's own
+    chunks must keep running in parallel, so extra chunks from a request
+    already in the batch are dispatched on their own straight away.
+    """
+
+    def __init__(self, max_batch=8, max_wait_ms=75):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue = None
+        self._worker = None
+        # Strong references to dispatch tasks so they are not collected mid-flight
+        self._tasks = set()
+
+    async def submit(self, prompt, num_questions, request_id):
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((prompt, num_questions, request_id, future))
+        return await future
+
+    def _start_dispatch(self, batch):
+        task = asyncio.create_task(self._dispatch(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            request_ids = {batch[0][2]}
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item[2] in request_ids:
+                    self._start_dispatch([item])
+                else:
+                    request_ids.add(item[2])
+                    batch.append(item)
+            self._start_dispatch(batch)
+
+    async def _dispatch(self, batch):
+        prompts = [prompt for prompt, _, _, _ in batch]
+        if len(batch) == 1:
+            results = await asyncio.gather(_generate_text(prompts[0]), return_exceptions=True)
+        else:
+            results = await self._generate_batch(prompts, [count for _, count, _, _ in batch])
+        for (_, _, _, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def _generate_batch(self, prompts, counts):
+        nonces = [uuid.uuid4().hex for _ in prompts]
+        contents = [BATCH_PREAMBLE.format(count=len(prompts))]
+        contents.extend(f"=== REQUEST {nonce} ===\n{prompt}" for nonce, prompt in zip(nonces, prompts))
+        try:
+            text = await _generate_text(contents)
+            sections = BATCH_RESPONSE_MARKER.split(text or '')
+            # split() yields [preamble, id, body, id, body, ...]
+            ids, bodies = sections[1::2], sections[2::2]
+            answers = dict(zip(ids, bodies))
+            if sorted(ids) == sorted(nonces) and all(
+                answers[nonce].count("## MCQ") == count for nonce, count in zip(nonces, counts)
+            ):
+                logging.info(f"Served {len(prompts)} prompts with one Gemini call")
+                return [answers[nonce].strip() for nonce in nonces]
+            logging.warning("Batched Gemini response did not match the prompts; retrying individually")
+        except Exception:
+            logging.exception("Batched Gemini call failed; retrying individually")
+        return await asyncio.gather(*(_generate_text(prompt) for prompt in prompts), return_exceptions=True)
+
+gemini_batcher = AsyncBatcher()
+
+def _response_text(response):
+    try:
+        if hasattr(response, "text") and response.text:
+            return response.text
+    except ValueError:
+        # .text raises when the candidate carries no text parts
+        pass
+    if hasattr(response, "candidates") and response.candidates:
+        text_parts = []
+        for part in response.candidates[0].content.parts:
+            if hasattr(part, "text") and part.text:
+                text_parts.append(part.text)
+        if text_parts:
+            return "\n".join(text_parts)
+    return None
 
 def save_mcqs_to_file(mcqs, filename):
     results_path = os.path.join(app.config['RESULTS_FOLDER'], filename)
@@ -91,67 +644,145 @@ def save_mcqs_to_file(mcqs, filename):
         return None
 
 def create_pdf(mcqs, filename):
-    pdf = FPDF()
-    pdf.add_page()
-    pdf.set_font("Arial", size=12)
+    styles = getSampleStyleSheet()
+    story = []
     try:
         for mcq in mcqs.split("## MCQ"):
             if mcq.strip():
-                pdf.multi_cell(0, 10, mcq.strip())
-                pdf.ln(5)
+                story.append(Paragraph(escape(mcq.strip()).replace("\n", "<br/>"), styles["Normal"]))
+                story.append(Spacer(1, 12))
         pdf_path = os.path.join(app.config['RESULTS_FOLDER'], filename)
-        pdf.output(pdf_path)
+        SimpleDocTemplate(pdf_path, pagesize=A4).build(story)
         return pdf_path
     except Exception as e:
         logging.error(f"Error creating PDF: {e}")
         return None
 
+def _job_marker_path(job_id):
+    return os.path.join(app.config['JOBS_FOLDER'], f"{job_id}.json")
+
+def _expire_job_markers():
+    cutoff = time.time() - JOB_MARKER_TTL_SECONDS
+    try:
+        with os.scandir(app.config['JOBS_FOLDER']) as entries:
+            for entry in entries:
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+    except OSError as e:
+        logging.error(f"Error expiring job markers: {e}")
+
+def _persist(mcqs, txt_filename, pdf_filename, job_id):
+    status = {
+        "txt": save_mcqs_to_file(mcqs, txt_filename) is not None,
+        "pdf": create_pdf(mcqs, pdf_filename) is not None,
+    }
+    marker_path = _job_marker_path(job_id)
+    tmp_path = f"{marker_path}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(status, f)
+        os.replace(tmp_path, marker_path)
+    except OSError as e:
+        logging.error(f"Error recording job status: {e}")
+    _expire_job_markers()
+
+async def _stream_and_capture(mcq_stream, txt_filename, pdf_filename, result):
+    pieces = []
+    try:
+        async for piece in mcq_stream:
+            pieces.append(piece)
+            yield piece
+    except Exception:
+        logging.exception("Error in MCQ generation process")
+
+    mcqs = merge_mcqs([''.join(pieces)])
+    if mcqs:
+        job_id = uuid.uuid4().hex
+        persist_executor.submit(_persist, mcqs, txt_filename, pdf_filename, job_id)
+        result["job_id"] = job_id
+    result["mcqs"] = mcqs
+
 @app.route('/')
-def index():
-    return render_template('index.html')
+async def index():
+    return await render_template('index.html')
 
 @app.route('/generate', methods=['POST'])
-def generate_mcqs():
-    if 'file' not in request.files:
+async def generate_mcqs():
+    files = await request.files
+    if 'file' not in files:
         return "No file part"
     
-    file = request.files['file']
+    file = files['file']
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(file_path)
+        # Unique on disk so concurrent uploads of the same name don't collide
+        file_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{uuid.uuid4().hex}_{filename}")
+        await file.save(file_path)
         
-        text = extract_text_from_file(file_path)
+        # Parsing and PDF layout are blocking; keep them off the event loop.
+        # The extracted text is cached by content hash, so the upload itself
+        # is no longer needed afterwards.
+        try:
+            text = await asyncio.to_thread(extract_text_cached, file_path)
+        finally:
+            try:
+                os.remove(file_path)
+            except OSError as e:
+                logging.error(f"Error removing upload: {e}")
         if not text:
             return "Text extraction failed."
 
         try:
-            num_questions = int(request.form['num_questions'])
-            mcqs = Question_mcqs_generator(text, num_questions)
-            if not mcqs:
-                return "MCQ generation failed. Check server logs for details."
-            
-            txt_filename = f"generated_mcqs_{filename.rsplit('.', 1)[0]}.txt"
-            pdf_filename = f"generated_mcqs_{filename.rsplit('.', 1)[0]}.pdf"
-            save_mcqs_to_file(mcqs, txt_filename)
-            create_pdf(mcqs, pdf_filename)
-            
-            return render_template('results.html', mcqs=mcqs, txt_filename=txt_filename, pdf_filename=pdf_filename)
-        except Exception as e:
-            logging.exception("Error in MCQ generation process")
+            form = await request.form
+            num_questions = int(form['num_questions'])
+        except (KeyError, ValueError):
+            logging.exception("Invalid number of questions")
             return "An error occurred during MCQ generation."
+
+        txt_filename = f"generated_mcqs_{filename.rsplit('.', 1)[0]}.txt"
+        pdf_filename = f"generated_mcqs_{filename.rsplit('.', 1)[0]}.pdf"
+        # Filled in once the stream ends so the template can render the result
+        result = {}
+        chunks = _stream_and_capture(Question_mcqs_generator(text, num_questions), txt_filename, pdf_filename, result)
+        return await stream_template('results.html', chunks=chunks, result=result, txt_filename=txt_filename, pdf_filename=pdf_filename)
     
     return "Invalid file format or upload issue"
 
+@app.route('/status/<job_id>')
+async def job_status(job_id):
+    try:
+        job_id = uuid.UUID(hex=job_id).hex
+    except ValueError:
+        return {"error": "Unknown job"}, 404
+    try:
+        with open(_job_marker_path(job_id), 'r', encoding='utf-8') as f:
+            status = json.load(f)
+    except FileNotFoundError:
+        return {"ready": False}
+    return {"ready": True, **status}
+
 @app.route('/download/<filename>')
-def download_file(filename):
+async def download_file(filename):
     file_path = os.path.join(app.config['RESULTS_FOLDER'], filename)
     if os.path.exists(file_path):
-        return send_file(file_path, as_attachment=True)
+        accel_prefix = app.config['X_ACCEL_REDIRECT_PREFIX']
+        if accel_prefix:
+            response = Response('')
+            response.headers['X-Accel-Redirect'] = f"{accel_prefix.rstrip('/')}/{filename}"
+            response.headers.set('Content-Disposition', 'attachment', filename=filename)
+            return response
+        return await send_file(file_path, as_attachment=True, conditional=True)
     else:
         return "File not found."
 
 
+# Local development only. In production run the ASGI server from the
+# Procfile, which starts two async workers, each serving many uploads
+# concurrently:
+#   WEB_CONCURRENCY=2 hypercorn app:app --bind 0.0.0.0:$PORT --workers 2
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port, debug=True)
+    app.run(host="0.0.0.0", port=port)